@@ -1,11 +1,27 @@
+import asyncio
+import contextlib
 import hashlib
 import os.path
 import re
+import shutil
+import sys
+import tempfile
+import zlib
 import functools
+import gzip
+import operator
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Set, Optional, Collection, Callable, TypeVar
+from typing import List, Set, Optional, Collection, Callable, TypeVar, Tuple, Union, Mapping, Iterator, BinaryIO, \
+    TYPE_CHECKING
 
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    import numpy as np
 
 
 class EUnit(Enum):
@@ -14,11 +30,54 @@ class EUnit(Enum):
     KiB = "KiB"
 
 
+_UNIT_BY_STR = {u.value: u for u in EUnit}
+_UNIT_TO_MIB = {EUnit.KiB: 1 / 1024, EUnit.MiB: 1, EUnit.GiB: 1024}
+
 G_LINK = "link"
 G_TITLE = "title"
 G_SIZE = "size"
 G_UNIT = "unit"
 
+_ROW_START = b'<tr><td><a href="'
+_TITLE_START = b'" title="'
+_TITLE_END = b'">'
+_SIZE_START = b'</a></td><td>'
+_SIZE_END = b'</td>'
+_ROW_END = b'</tr>'
+_SIZE_RE = re.compile(rf"(?P<{G_SIZE}>\d+(?:\.\d+)?) (?P<{G_UNIT}>KiB|MiB|GiB)".encode())
+_UPPER_DIR_RE = re.compile(
+    rf"<td><a href=\"(?P<{G_LINK}>[^\"]+)\"(?: title=\"(?P<{G_TITLE}>[^\"]*)\")?>[^\"]*</a></td>", re.ASCII)
+
+_URL_KEEP_CHARACTERS = (' ', '.', '_')
+
+
+class _UrlStripTable(dict):
+    """str.translate table dropping everything except alphanumerics and a few safe characters,
+    filled in per code point on first use so it covers any character a url can contain"""
+
+    def __missing__(self, code_point: int) -> Optional[str]:
+        c = chr(code_point)
+        self[code_point] = result = c if c.isalnum() or c in _URL_KEEP_CHARACTERS else None
+        return result
+
+
+_URL_STRIP_TABLE = _UrlStripTable()
+
+CACHE_DIR = "cache"
+CACHE_COMPRESS_LEVEL = 3
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+FETCH_CONCURRENCY = 32
+FETCH_TIMEOUT = 30
+FETCH_CHUNK_SIZE = 1 << 20
+FETCH_RETRIES = 3
+FETCH_BACKOFF_FACTOR = 0.3
+FETCH_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                       max_retries=Retry(total=FETCH_RETRIES, backoff_factor=FETCH_BACKOFF_FACTOR)))
+
 
 class BaseEntry:
     def __init__(self, name: str):
@@ -28,49 +87,48 @@ class BaseEntry:
     def games(self) -> Set['Game']:
         raise NotImplementedError()
 
-    @property
+    @functools.cached_property
     def mib(self):
-        return functools.reduce(lambda a, b: a + b.mib, self.games, 0)
+        return sum(g.mib for g in self.games)
 
 
 class UrlEntry(BaseEntry):
     def __init__(self, url: str, name: str):
         super().__init__(name)
-        self._games = set(parse_url(url, _parse_games))
+        self._games = set(_cached_games_for_url(url))
+        self._total_mib = sum(g.mib for g in self._games)
 
     @property
     def games(self) -> Set['Game']:
         return self._games
 
+    @property
+    def mib(self):
+        return self._total_mib
+
 
 class CollectionEntry(BaseEntry):
     def __init__(self, name: str, entries: List[BaseEntry]):
         super().__init__(name)
         self.entries = entries
 
-    @property
+    @functools.cached_property
     def games(self) -> Set['Game']:
-        def reduce_func(previous: Set['Game'], addend: Set['Game']) -> Set['Game']:
-            return previous.union(addend)
-
-        return functools.reduce(reduce_func, [entry.games for entry in self.entries], set())
+        games = set()
+        games.update(*(entry.games for entry in self.entries))
+        return games
 
 
+@dataclass(slots=True, frozen=True)
 class Game:
-    def __init__(self, match: re.Match):
-        self.link = match.group(G_LINK)
-        self.title = match.group(G_TITLE)
-        self.size = float(match.group(G_SIZE))
-
-        unit = match.group(G_UNIT)
-        unit_set = False
-        for unit_value in EUnit:
-            if unit == str(unit_value.value):
-                self.unit = unit_value
-                unit_set = True
-                break
-        if not unit_set:
-            raise Exception(f"Failed to parse unit '{unit}'")
+    link: str = field(compare=False)
+    title: str
+    size: float
+    unit: EUnit
+    _mib: float = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "_mib", self.size * _UNIT_TO_MIB[self.unit])
 
     def __repr__(self):
         return str(self)
@@ -78,93 +136,260 @@ class Game:
     def __str__(self):
         return f"{self.size} {self.unit.value} - '{self.title}' | ({self.link})"
 
-    def __eq__(self, other: 'Game'):
-        return self.title == other.title and self.size == other.size and self.unit == other.unit
-
-    def __hash__(self):
-        return self.title.__hash__() * 11 + \
-            self.size.__hash__() * 17 + \
-            self.size.__hash__() * self.unit.value.__hash__()
-
     @property
     def gib(self) -> float:
-        if self.unit == EUnit.GiB:
-            return self.size
-        if self.unit == EUnit.MiB:
-            return self.size / 1024
-        if self.unit == EUnit.KiB:
-            return self.size / 1024 / 1024
-        raise Exception("Invalid unit")
+        return self._mib / 1024
+
+    @property
+    def mib(self) -> float:
+        return self._mib
+
+
+class GameTable:
+    """Games stored column-wise, so that filtering and summing run vectorized instead of per Game object.
+    numpy is only imported once a table is built, the rest of the script doesn't need it."""
+
+    def __init__(self, titles: 'np.ndarray', sizes_mib: 'np.ndarray'):
+        self.titles = titles
+        self.sizes_mib = sizes_mib
+
+    @classmethod
+    def from_games(cls, games: Collection[Game]) -> 'GameTable':
+        import numpy as np
+        return cls(np.array([g.title for g in games], dtype=str),
+                   np.fromiter((g.mib for g in games), dtype=np.float64, count=len(games)))
+
+    def __len__(self):
+        return len(self.titles)
 
     @property
     def mib(self) -> float:
-        if self.unit == EUnit.KiB:
-            return self.size / 1024
-        if self.unit == EUnit.MiB:
-            return self.size
-        if self.unit == EUnit.GiB:
-            return self.size * 1024
-        raise Exception("Invalid unit")
+        return float(self.sizes_mib.sum())
+
+    def title_contains(self, text: str) -> 'np.ndarray':
+        import numpy as np
+        return np.char.find(self.titles, text) >= 0
+
+    def where(self, mask: 'np.ndarray') -> 'GameTable':
+        return GameTable(self.titles[mask], self.sizes_mib[mask])
+
 
+def _parse_unit(unit: str) -> EUnit:
+    try:
+        return _UNIT_BY_STR[unit]
+    except KeyError:
+        raise ValueError(f"Failed to parse unit '{unit}'") from None
 
-def _parse_games(content: str) -> List[Game]:
-    pattern = rf'<tr><td><a href=\"(?P<{G_LINK}>.+)\" title=\".*\">(?P<{G_TITLE}>.*)</a></td><td>(?P<{G_SIZE}>.+) (?P<{G_UNIT}>KiB|MiB|GiB)</td><td>.*</td></tr>'
-    return [Game(m) for m in re.finditer(pattern, content)]
+
+def _parse_games(content: bytes) -> List[Game]:
+    # Single forward scan over the table rows, avoids regex backtracking across the whole listing
+    result = []
+    pos = content.find(_ROW_START)
+    while pos != -1:
+        row_end = content.find(_ROW_END, pos)
+        if row_end == -1:
+            break
+        game = _parse_game_row(content, pos + len(_ROW_START), row_end)
+        if game is not None:
+            result.append(game)
+        pos = content.find(_ROW_START, row_end)
+    return result
+
+
+def _parse_game_row(content: bytes, link_start: int, row_end: int) -> Optional[Game]:
+    # Every anchor is searched for within the row only, rows without them (e.g. the parent directory) are skipped
+    link_end = content.find(_TITLE_START, link_start, row_end)
+    if link_end == -1:
+        return None
+    title_start = content.find(_TITLE_END, link_end + len(_TITLE_START), row_end)
+    if title_start == -1:
+        return None
+    title_start += len(_TITLE_END)
+    title_end = content.find(_SIZE_START, title_start, row_end)
+    if title_end == -1:
+        return None
+    size_start = title_end + len(_SIZE_START)
+    size_end = content.find(_SIZE_END, size_start, row_end)
+    if size_end == -1:
+        return None
+
+    size_match = _SIZE_RE.fullmatch(content, size_start, size_end)
+    if not size_match:
+        return None
+    return Game(content[link_start:link_end].decode(), content[title_start:title_end].decode(),
+                float(size_match.group(G_SIZE)), _parse_unit(size_match.group(G_UNIT).decode()))
 
 
 T = TypeVar("T")
 
 
-def parse_file(filepath: str, parse_func: Callable[[str], T]) -> T:
-    with open(filepath, "r") as f:
-        text = f.read()
-    return parse_func(text)
+def parse_file(filepath: str, parse_func: Callable[[bytes], T]) -> T:
+    with (gzip.open if filepath.endswith(".gz") else open)(filepath, "rb") as f:
+        content = f.read()
+    return parse_func(content)
+
+
+def _cache_path(url: str) -> str:
+    conformed_url = url.translate(_URL_STRIP_TABLE).rstrip()
+    return CACHE_DIR + os.sep + conformed_url + "__" + f"{zlib.crc32(url.encode('utf-8')):08x}" + ".html.gz"
+
+
+def _legacy_cache_paths(url: str) -> Tuple[str, ...]:
+    conformed_url = url.translate(_URL_STRIP_TABLE).rstrip()
+    url_bytes = url.encode('utf-8')
+    return (
+        CACHE_DIR + os.sep + conformed_url + "__" + f"{zlib.crc32(url_bytes):08x}" + ".html",
+        CACHE_DIR + os.sep + conformed_url + "__" + hashlib.md5(url_bytes).hexdigest() + ".html",
+    )
+
+
+@contextlib.contextmanager
+def _atomic_cache_file(file_path: str) -> Iterator[BinaryIO]:
+    """Yields a temporary file that is only moved onto file_path once the block finishes without errors"""
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _is_cached(file_path: str) -> bool:
+    try:
+        os.stat(file_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _migrate_legacy_cache(url: str, file_path: str) -> bool:
+    """Compresses a cache file from an older layout (uncompressed, possibly keyed by an md5 of the url)
+    into file_path and removes the original. Returns whether there was one to migrate."""
+    for legacy_file_path in _legacy_cache_paths(url):
+        try:
+            with open(legacy_file_path, "rb") as src, _atomic_cache_file(file_path) as f, \
+                    gzip.open(f, "wb", compresslevel=CACHE_COMPRESS_LEVEL) as dst:
+                shutil.copyfileobj(src, dst, FETCH_CHUNK_SIZE)
+        except FileNotFoundError:
+            continue
+        os.remove(legacy_file_path)
+        return True
+    return False
 
 
-def parse_url(url: str, parse_func: Callable[[str], T], invalidate_cache: bool = False) -> T:
-    keep_characters = (' ', '.', '_')
-    conformed_url = "".join(c for c in url if c.isalnum() or c in keep_characters).rstrip()
-    cache_dir = "cache"
-    if not os.path.isdir(cache_dir):
-        os.mkdir(cache_dir)
-    file_path = cache_dir + os.sep + conformed_url + "__" + hashlib.md5(url.encode('utf-8')).hexdigest() + ".html"
-    if invalidate_cache and os.path.exists(file_path):
-        os.remove(file_path)
-    if os.path.exists(file_path) and os.path.isfile(file_path):
-        return parse_file(file_path, parse_func)
-    else:
+def _is_gzip_encoded(headers: Mapping[str, str]) -> bool:
+    return headers.get("Content-Encoding", "").lower() == "gzip"
+
+
+async def _fetch(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str):
+    async with semaphore:
         print(f"Url '{url}' not cached, fetching")
-        text = requests.get(url).text
-        with open(file_path, "w") as f:
-            f.write(text)
-        return parse_func(text)
+        # Mirrors the Retry used by the serial session, plus the statuses a burst of parallel requests can cause
+        for attempt in range(FETCH_RETRIES + 1):
+            try:
+                async with session.get(url, headers={"Accept-Encoding": "gzip"}) as response:
+                    response.raise_for_status()
+                    content = await response.read()
+                    gzip_encoded = _is_gzip_encoded(response.headers)
+                break
+            except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in FETCH_RETRY_STATUSES
+                if not retryable or attempt == FETCH_RETRIES:
+                    raise
+                await asyncio.sleep(FETCH_BACKOFF_FACTOR * 2 ** attempt)
+        if not gzip_encoded:
+            content = gzip.compress(content, compresslevel=CACHE_COMPRESS_LEVEL)
+    # Already gzip encoded responses are cached as is
+    with _atomic_cache_file(_cache_path(url)) as f:
+        f.write(content)
+
+
+async def _fetch_all(urls: Collection[str]):
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(auto_decompress=False, timeout=timeout) as session:
+        async with asyncio.TaskGroup() as tg:
+            for url in urls:
+                tg.create_task(_fetch(session, semaphore, url))
+
+
+def fetch_missing(urls: Collection[str]):
+    """Concurrently fetches every url that isn't cached yet, so that parsing them afterwards only hits the cache"""
+    missing = []
+    for url in dict.fromkeys(urls):
+        file_path = _cache_path(url)
+        if not _is_cached(file_path) and not _migrate_legacy_cache(url, file_path):
+            missing.append(url)
+    if missing:
+        asyncio.run(_fetch_all(missing))
+
+
+def parse_url(url: str, parse_func: Callable[[bytes], T], invalidate_cache: bool = False) -> T:
+    file_path = _cache_path(url)
+    if invalidate_cache:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path)
+    elif _is_cached(file_path) or _migrate_legacy_cache(url, file_path):
+        return parse_file(file_path, parse_func)
+
+    print(f"Url '{url}' not cached, fetching")
+    with _SESSION.get(url, stream=True, timeout=FETCH_TIMEOUT, headers={"Accept-Encoding": "gzip"}) as response:
+        response.raise_for_status()
+        if _is_gzip_encoded(response.headers):
+            # Already gzip encoded responses are cached as is
+            with _atomic_cache_file(file_path) as f:
+                shutil.copyfileobj(response.raw, f, FETCH_CHUNK_SIZE)
+        else:
+            # Let urllib3 undo any other transfer compression while streaming
+            response.raw.decode_content = True
+            with _atomic_cache_file(file_path) as f, gzip.open(f, "wb", compresslevel=CACHE_COMPRESS_LEVEL) as dst:
+                shutil.copyfileobj(response.raw, dst, FETCH_CHUNK_SIZE)
+    return parse_file(file_path, parse_func)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_games_for_url(url: str) -> Tuple[Game, ...]:
+    # Memoized so that urls appearing in several entries are only read and parsed once per run
+    return tuple(parse_url(url, _parse_games))
 
 
 def print_entry_info(entry: BaseEntry, depth: int = 0,
                      sub_entries_depth_limit: Optional[int] = None):
-    games = entry.games
-    print_games_info(games, entry.name, depth, newline=False)
-
-    if (sub_entries_depth_limit is None or depth < sub_entries_depth_limit) \
-            and isinstance(entry, CollectionEntry) and len(entry.entries) > 0:
-        for child_entry in entry.entries:
-            print_entry_info(child_entry, depth=depth + 1,
-                             sub_entries_depth_limit=sub_entries_depth_limit)
-    else:
-        print()
+    # Walks the tree with an explicit stack and writes the whole output at once
+    parts = []
+    stack = [(entry, depth)]
+    while stack:
+        entry, depth = stack.pop()
+        _format_games_info(parts, entry.games, entry.name, depth)
+
+        if (sub_entries_depth_limit is None or depth < sub_entries_depth_limit) \
+                and isinstance(entry, CollectionEntry) and len(entry.entries) > 0:
+            stack.extend((child_entry, depth + 1) for child_entry in reversed(entry.entries))
+        else:
+            parts.append("\n")
+    sys.stdout.write("".join(parts))
+
+
+def print_games_info(games: Union[Collection[Game], GameTable], name: str, depth: int = 0,
+                     newline: bool = True):
+    parts = []
+    _format_games_info(parts, games, name, depth)
+    if newline:
+        parts.append("\n")
+    sys.stdout.write("".join(parts))
 
 
-def print_games_info(games: Collection[Game], name: str, depth: int = 0, newline: bool = True):
+def _format_games_info(parts: List[str], games: Union[Collection[Game], GameTable], name: str, depth: int):
     prefix = depth * "   "
-    print(prefix + name)
-    print(prefix + "Amount:", len(games))
-    games_sum = functools.reduce(lambda a, b: a + b.mib, games, 0)
+    parts.append(f"{prefix}{name}\n")
+    parts.append(f"{prefix}Amount: {len(games)}\n")
+    games_sum = games.mib if isinstance(games, GameTable) else sum(g.mib for g in games)
     if games_sum > 1024:
-        print(prefix + "Size:", round(games_sum / 1024, 1), "GiB")
+        parts.append(f"{prefix}Size: {round(games_sum / 1024, 1)} GiB\n")
     else:
-        print(prefix + "Size:", round(games_sum, 1), "MiB")
-    if newline:
-        print()
+        parts.append(f"{prefix}Size: {round(games_sum, 1)} MiB\n")
 
 
 class PageEntry:
@@ -173,11 +398,9 @@ class PageEntry:
 
 
 def parse_upper_dir_contents(base_url: str, content: str) -> List[UrlEntry]:
-    pattern = rf"<td><a href=\"(?P<{G_LINK}>[^\"]+)\"(?: title=\"(?P<{G_TITLE}>[^\"]*)\")?>[^\"]*</a></td>"
+    found = []
 
-    result = []
-
-    for m in re.finditer(pattern, content):
+    for m in _UPPER_DIR_RE.finditer(content):
         title_group = m.group(G_TITLE)
         link = m.group(G_LINK)
         if link == "../":
@@ -191,27 +414,28 @@ def parse_upper_dir_contents(base_url: str, content: str) -> List[UrlEntry]:
             link = link[1:]
         combined_url += link
 
-        result.append(UrlEntry(combined_url, title))
+        found.append((combined_url, title))
 
-    return result
+    fetch_missing([combined_url for combined_url, _ in found])
+    return [UrlEntry(combined_url, title) for combined_url, title in found]
 
 
 def parse_upper_dir(url: str, name: Optional[str] = None) -> CollectionEntry:
-    entries = parse_url(url, lambda content: parse_upper_dir_contents(url, content))
+    entries = parse_url(url, lambda content: parse_upper_dir_contents(url, content.decode()))
     return CollectionEntry(name if name else url, entries)
 
 
 if __name__ == '__main__':
     no_intro_entry = parse_upper_dir("https://myrient.erista.me/files/No-Intro/")
-    no_intro_entry.entries.sort(key=lambda e: e.mib)
+    no_intro_entry.entries.sort(key=operator.attrgetter("mib"))
     print_entry_info(no_intro_entry)
 
     redump_entry = parse_upper_dir("https://myrient.erista.me/files/Redump/")
-    redump_entry.entries.sort(key=lambda e: e.mib)
+    redump_entry.entries.sort(key=operator.attrgetter("mib"))
     print_entry_info(redump_entry)
 
     miscellaneous_entry = parse_upper_dir("https://myrient.erista.me/files/Miscellaneous/")
-    miscellaneous_entry.entries.sort(key=lambda e: e.mib)
+    miscellaneous_entry.entries.sort(key=operator.attrgetter("mib"))
     print_entry_info(miscellaneous_entry)
 
     # atari_2600 = UrlEntry(
@@ -266,14 +490,15 @@ if __name__ == '__main__':
     #
     # print_entry_info(all_games)
 
-    # print_games_info([g for g in g3ds.games if "Europe" in g.title], "Only Europe")
-    # print_games_info([g for g in g3ds.games if "USA" in g.title], "Only USA")
-    # print_games_info([g for g in g3ds.games if "Japan" not in g.title], "No Japan")
-    # print_games_info([g for g in g3ds.games if g.gib < 1], "Only games < 1 GiB")
-    # print_games_info([g for g in g3ds.games if g.gib < 0.7], "Only games < 0.7 GiB")
-    # print_games_info([g for g in g3ds.games if g.gib < 0.4], "Only games < 0.4 GiB")
+    # g3ds_table = GameTable.from_games(g3ds.games)
+    # print_games_info(g3ds_table.where(g3ds_table.title_contains("Europe")), "Only Europe")
+    # print_games_info(g3ds_table.where(g3ds_table.title_contains("USA")), "Only USA")
+    # print_games_info(g3ds_table.where(~g3ds_table.title_contains("Japan")), "No Japan")
+    # print_games_info(g3ds_table.where(g3ds_table.sizes_mib < 1 * 1024), "Only games < 1 GiB")
+    # print_games_info(g3ds_table.where(g3ds_table.sizes_mib < 0.7 * 1024), "Only games < 0.7 GiB")
+    # print_games_info(g3ds_table.where(g3ds_table.sizes_mib < 0.4 * 1024), "Only games < 0.4 GiB")
     # print_games_info(g3ds_eshop.games, "Only eshop games")
     # print_games_info(set.union(g3ds_reg.games, g3ds_new.games), "Only non-eshop games")
-    # print_games_info([g for g in g3ds.games if "(Demo)" in g.title], "Only demos")
-    # print_games_info([g for g in g3ds.games if "Doko Demo Honya-san" in g.title],
+    # print_games_info(g3ds_table.where(g3ds_table.title_contains("(Demo)")), "Only demos")
+    # print_games_info(g3ds_table.where(g3ds_table.title_contains("Doko Demo Honya-san")),
     #                  "Only \"Doko Demo Honya-san\" games (wtf)")